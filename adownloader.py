@@ -1,25 +1,80 @@
 import asyncio
+import contextlib
+import errno
+import functools
+import json
+import os
+import shutil
 from pathlib import Path
-from typing import AsyncIterator
+from typing import AsyncIterator, Awaitable, Callable
 
 import aiohttp
-import aiofiles
+import yarl
 import rich
 import rich.progress
 import rich.theme
-from collections import namedtuple
+from dataclasses import dataclass
 
-_FileInfo = namedtuple('FileInfo', ['url', 'path', 'size', 'accept_ranges'])
+try:
+    import aiofile  # Optional, uses Linux AIO (caio), thread pool elsewhere
+except ImportError:
+    aiofile = None
+
+
+@dataclass(slots=True)
+class _FileInfo:
+    url: yarl.URL
+    path: Path
+    size: int|None  # None until known when HEAD request was skipped
+    accept_ranges: str|None
 
 
 class SortedRichProgress(rich.progress.Progress):
     """ Makes so the newest tasks are at the top """
     def get_renderables(self):
-        table = self.make_tasks_table(list(sorted(self.tasks, key=lambda task: task.id, reverse=True)))
+        # Tasks are kept in order they were added, so no need to sort
+        table = self.make_tasks_table(list(reversed(self.tasks)))
         yield table
 
+class _ProgressBatch:
+    """ Passes bytes completed to progress tasks as advances every step bytes or interval seconds """
+    def __init__(self, progress: rich.progress.Progress, *tasks: rich.progress.TaskID, step: int, interval: float):
+        self.progress = progress
+        self.tasks = tasks
+        self.step = step
+        self.interval = interval
+        self.loop = asyncio.get_running_loop()
+        self.completed = 0
+        self.reported = 0
+        self.deadline = self.loop.time() + interval
+
+    def update(self, completed: int):
+        self.completed = completed
+        if completed - self.reported >= self.step or self.loop.time() >= self.deadline:
+            self.flush()
+
+    def flush(self):
+        if self.completed != self.reported:
+            for task in self.tasks:
+                self.progress.update(task, advance=self.completed - self.reported)
+            self.reported = self.completed
+        self.deadline = self.loop.time() + self.interval
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+
 class AsyncDownloader:
-    CHUNK_SIZE = 65536
+    CHUNK_SIZE = 1 << 20  # Used as write buffer size, reads are as large as network delivers
+    SEGMENT_THRESHOLD = 16 * 1024 * 1024  # Files larger than this are downloaded in parallel byte ranges
+    SEGMENTS = 4
+    CHECKS_PER_DOWNLOAD = 4  # HEAD requests are cheap, so check ahead of downloads
+    WRITE_QUEUE_SIZE = 8  # Chunks buffered in memory while the writer is busy
+    PROGRESS_STEP = 512 * 1024  # Rich update per chunk is costly on fast links, so update at most this often
+    PROGRESS_INTERVAL = 0.05
 
     def __init__(self, download_dir:str|Path='.', concurrent_downloads: int=5,
                  allow_override=True, allow_partial=True, timeout=30, console=None):
@@ -27,7 +82,9 @@ class AsyncDownloader:
         if self.console is None:
             self.console = rich.get_console()
             self.console.use_theme(rich.theme.Theme({"progress.description": "yellow"}))
-        self.semaphore = asyncio.Semaphore(concurrent_downloads)
+        self.concurrent_downloads = concurrent_downloads
+        self._check_sem = asyncio.Semaphore(concurrent_downloads * self.CHECKS_PER_DOWNLOAD)
+        self._download_sem = asyncio.Semaphore(concurrent_downloads)
         self.progress = SortedRichProgress(
             rich.progress.TextColumn("[progress.description]{task.description}"),
             rich.progress.TaskProgressColumn(),
@@ -35,7 +92,7 @@ class AsyncDownloader:
             rich.progress.DownloadColumn(binary_units=True),
             rich.progress.TransferSpeedColumn(),
             rich.progress.TimeRemainingColumn(),
-            console=console, expand=True,
+            console=console, expand=True, refresh_per_second=4,
         )
         self.session: aiohttp.ClientSession|None = None
         self.download_dir = Path(download_dir).absolute()
@@ -48,8 +105,12 @@ class AsyncDownloader:
         self._main_task: rich.progress.TaskID = 0
         self._file_queue: asyncio.Queue[Path] = asyncio.Queue()
         self._download_tasks: list[asyncio.Task] = []
+        # Only touched from the event loop, so no locking needed
+        self._urls: tuple[str|tuple[str, str]|tuple[str,Path], ...] = ()
         self._files_checked = 0
-        self._prog_lock = asyncio.Lock()
+        self._total_bytes = 0
+        self._bytes_needed = 0  # Sum of bytes checked files still need on disk
+        self._free_space = 0  # Free disk space when download started, so writes since then don't count twice
 
     async def _check_file(self, request:str|tuple[str, str]|tuple[str,Path]):
         filename = None
@@ -57,32 +118,44 @@ class AsyncDownloader:
             url, filename = request
         else:
             url = request
-        async with self.semaphore:
-            async with self._prog_lock:  # do this first before exception
-                checked = self.progress.tasks[self._main_task].fields['files_checked'] + 1
-                total_files = self.progress.tasks[self._main_task].fields['files_total']
-                desc = "Total" if checked == total_files else f"Checking {checked}/{total_files}"
-                self.progress.update(self._main_task, description=desc, files_checked=checked)
-            async with self.session.head(url, allow_redirects=True, timeout=self.timeout) as resp:
+        async with self._check_sem:
+            # do this first before exception
+            self._files_checked += 1
+            checked = self._files_checked
+            total_files = len(self._urls)
+            desc = "Total" if checked == total_files else f"Checking {checked}/{total_files}"
+            self.progress.update(self._main_task, description=desc, files_checked=checked)
+            if filename is not None:
+                path = self.download_dir / filename if isinstance(filename, str) else filename
+                if not path.exists() and not (self.allow_partial and path.with_suffix('.part').exists()):
+                    # Nothing to compare or resume, size and range support will be taken from GET response
+                    return _FileInfo(yarl.URL(url), path, None, None)
+            async with self.session.head(url, allow_redirects=True) as resp:
                 if not (resp.status <= 400):
                     self.console.print(f'Status [red]{resp.status}[/red]: {url}')
                     resp.raise_for_status()
-                try:
-                    size = int(resp.headers.get('content-length', 0))
-                except ValueError:
-                    size = 0
+                size = self._content_length(resp)
                 if filename is None:
                     if resp.content_disposition is not None:
                         filename = resp.content_disposition.filename
                     else:
                         filename = resp.url.path.split('/')[-1]
-            async with self._prog_lock:
-                total = self.progress.tasks[self._main_task].total or 0
-                self.progress.update(self._main_task, total=total + size)
+            self._add_total(size)
             if isinstance(filename, str):
                 filename = self.download_dir / filename
             return _FileInfo(resp.url, filename, size, resp.headers.get('accept-ranges'))
 
+    @staticmethod
+    def _content_length(resp: aiohttp.ClientResponse) -> int:
+        try:
+            return int(resp.headers.get('content-length', 0))
+        except ValueError:
+            return 0
+
+    def _add_total(self, size: int):
+        self._total_bytes += size
+        self.progress.update(self._main_task, total=self._total_bytes)
+
     async def _download_file(self, file: _FileInfo | None, retry=0) -> tuple[_FileInfo, int, bool]:
         if file.path.exists():
             if file.path.stat().st_size == file.size:
@@ -92,69 +165,305 @@ class AsyncDownloader:
                 self.console.print(f'[red]File already exists, but has different size, overriding[/red] [progress.description]{file.path}[/progress.description]')
             else:
                 self.console.print(f'[red]File already exists, but has different size, skipping[/red] [progress.description]{file.path}[/progress.description]')
-                return file.path, retry, True
-        use_partial = self.allow_partial and file.accept_ranges == 'bytes'  # Don't use if not supported by the server
+                return file, retry, True
         if retry > 0:
             # 1 retry 4 seconds, 2 = 7 sec, 6 ~= 17 sec and goes towards 60 sec max
             await asyncio.sleep(retry * 60 / (retry + 15))
-        async with self.semaphore:
+        async with self._download_sem:
             # Always download to .part in case the download is interrupted one could tell the difference
             filepath_part = file.path.with_suffix('.part')
-            headers = self.default_headers.copy()
-            offset = 0
-            if use_partial and filepath_part.exists():
-                offset = filepath_part.stat().st_size
-                headers['Range'] = f'bytes={offset}-'
+            filepath_idx = filepath_part.with_name(filepath_part.name + '.idx')
+            task_suffix = '' if retry == 0 else f' (retry {retry})'
+            task = self.progress.add_task(file.path.name + task_suffix, total=file.size)
+            resp = None
             try:
-                async with self.session.get(file.url, headers=headers, timeout=self.timeout) as resp:
-                    resp.raise_for_status()
-                    task_suffix = '' if retry == 0 else f' (retry {retry})'
-                    task = self.progress.add_task(file.path.name + task_suffix, total=file.size, completed=offset)
-                    self.progress.update(self._main_task, advance=offset)
-                    async with aiofiles.open(filepath_part, mode='ab' if offset > 0 else 'wb') as f:
-                        async for data in resp.content.iter_chunked(self.CHUNK_SIZE):
-                            await f.write(data)
-                            self.progress.update(task, advance=len(data))
-                            self.progress.update(self._main_task, advance=len(data))
+                if file.size is None:
+                    # HEAD was skipped, take size and range support from GET response instead
+                    resp = await self.session.get(file.url, headers=self.default_headers)
+                    if not resp.ok:
+                        self.console.print(f'Status [red]{resp.status}[/red]: {file.url}')
+                        resp.raise_for_status()
+                    file.size = self._content_length(resp)
+                    file.accept_ranges = resp.headers.get('accept-ranges')
+                    self._add_total(file.size)
+                    self.progress.update(task, total=file.size)
+                # Splitting needs ranges declared up front, while resuming a single stream is verified on response
+                segmented = self.allow_partial and file.accept_ranges == 'bytes' and file.size > self.SEGMENT_THRESHOLD
+                if segmented and resp is not None:
+                    resp.close()  # Parallel ranges are worth dropping this connection
+                    resp = None
+                if not segmented or not await self._download_segments(file, filepath_part, filepath_idx, task):
+                    offset = 0
+                    # Sparse .part left by segmented download cannot be resumed sequentially
+                    if self.allow_partial and filepath_part.exists() and not filepath_idx.exists():
+                        offset = filepath_part.stat().st_size
+                    filepath_idx.unlink(missing_ok=True)
+                    await self._download_stream(file, filepath_part, offset, task, resp)
             except TimeoutError:
                 self.console.print(f'[bold red]Timeout[bold red] [progress.description]{file.path.name}')
+                # Retry counts resumed bytes again from .part / .part.idx
+                completed = next(t.completed for t in self.progress.tasks if t.id == task)
+                self.progress.update(self._main_task, advance=-completed)
                 self.progress.remove_task(task)
                 return file, retry, False
-            filepath_part.rename(file.path)
+            filepath_part.replace(file.path)  # Atomic, and unlike rename overrides existing file on Windows
+            filepath_idx.unlink(missing_ok=True)
             self.console.print(f'Downloaded [progress.description]{file.path.name}')
             self.progress.remove_task(task)
         return file, retry, True
 
+    async def _download_stream(self, file: _FileInfo, filepath_part: Path, offset: int, task: rich.progress.TaskID,
+                               resp: aiohttp.ClientResponse|None = None):
+        """ Downloads file over a single connection, appending to .part from offset. Reads resp if already requested. """
+        if resp is None:
+            headers = self.default_headers.copy()
+            if offset > 0:
+                headers['Range'] = f'bytes={offset}-'
+            resp = await self.session.get(file.url, headers=headers)
+        async with resp:
+            resp.raise_for_status()
+            if offset > 0 and resp.status != 206:
+                # Range was ignored and full file is sent, appending it would corrupt .part
+                offset = 0
+            self.progress.update(task, completed=offset)
+            self.progress.update(self._main_task, advance=offset)
+            if offset == 0:
+                filepath_part.write_bytes(b'')
+            async with self._part_writer(filepath_part, offset) as write:
+                with self._progress_batch(task) as batch:
+                    # aiohttp already counts received bytes, so there is no need to sum chunk lengths
+                    async for data in resp.content.iter_any():
+                        await write(data)
+                        batch.update(resp.content.total_bytes)
+
+    async def _download_segments(self, file: _FileInfo, filepath_part: Path, filepath_idx: Path,
+                                 task: rich.progress.TaskID) -> bool:
+        """
+        Downloads file as SEGMENTS byte ranges concurrently, each written at its own offset in .part.
+        Completed segments are recorded in .part.idx so they are skipped when resuming.
+        Returns False if server does not honour ranges, in which case caller should fall back to a single stream.
+        """
+        seg = -(-file.size // self.SEGMENTS)
+        segments = [(i * seg, min(file.size, (i + 1) * seg) - 1) for i in range(self.SEGMENTS)]
+        done = set()
+        if filepath_part.exists() and filepath_idx.exists():
+            try:
+                state = json.loads(filepath_idx.read_text())
+                if state['size'] == file.size and state['segments'] == self.SEGMENTS:
+                    done = set(state['done'])
+            except (ValueError, KeyError, TypeError):
+                pass
+        def save_state():
+            filepath_idx.write_text(json.dumps({'size': file.size, 'segments': self.SEGMENTS, 'done': sorted(done)}))
+
+        # Written before any data so an interrupted .part is never mistaken for a sequential one
+        save_state()
+        resumed = sum(hi - lo + 1 for i, (lo, hi) in enumerate(segments) if i in done)
+        self.progress.update(task, completed=resumed)
+        self.progress.update(self._main_task, advance=resumed)
+        written = 0
+
+        async def fetch(i: int, lo: int, hi: int) -> bool:
+            nonlocal written
+            headers = self.default_headers.copy()
+            headers['Range'] = f'bytes={lo}-{hi}'
+            async with self.session.get(file.url, headers=headers) as resp:
+                resp.raise_for_status()
+                if resp.status != 206:
+                    return False
+                async with self._part_writer(filepath_part, lo) as write:
+                    with self._progress_batch(task) as batch:
+                        async for data in resp.content.iter_any():
+                            await write(data)
+                            batch.update(resp.content.total_bytes)
+                    written += batch.completed
+            done.add(i)
+            save_state()
+            return True
+
+        await asyncio.get_running_loop().run_in_executor(None, self._preallocate, filepath_part, file.size)
+        fetches = [asyncio.create_task(fetch(i, lo, hi)) for i, (lo, hi) in enumerate(segments) if i not in done]
+        try:
+            ok = all(await asyncio.gather(*fetches))
+        finally:
+            for fetch_task in fetches:
+                fetch_task.cancel()
+            await asyncio.gather(*fetches, return_exceptions=True)
+        if not ok:
+            # Undo progress of anything written, file will be downloaded from scratch
+            self.progress.update(task, completed=0)
+            self.progress.update(self._main_task, advance=-(resumed + written))
+        return ok
+
+    @staticmethod
+    def _preallocate(path: Path, size: int):
+        """
+        Creates path with size bytes reserved on disk, so segments written out of order don't fragment it.
+        Not used for sequential downloads, since there .part size is the resume offset.
+        """
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | getattr(os, 'O_BINARY', 0), 0o644)
+        try:
+            # fallocate only grows, stale .part larger than size would leave its tail in the final file
+            os.ftruncate(fd, size)
+            os.posix_fallocate(fd, 0, size)
+        except AttributeError:  # Not available on Windows and macOS, truncate is enough
+            pass
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise
+            # Filesystem does not support it, truncate is enough
+        finally:
+            os.close(fd)
+
+    def _progress_batch(self, task: rich.progress.TaskID) -> _ProgressBatch:
+        return _ProgressBatch(self.progress, task, self._main_task, step=self.PROGRESS_STEP, interval=self.PROGRESS_INTERVAL)
+
+    @contextlib.asynccontextmanager
+    async def _part_writer(self, path: Path, offset: int):
+        """
+        Yields async function writing chunks sequentially to existing path starting at offset.
+        Several writers may be open on the same file at different offsets.
+        """
+        if aiofile is not None:
+            async with aiofile.AIOFile(path, 'r+b') as afp:
+                async with self._writer(aiofile.Writer(afp, offset=offset)) as write:
+                    yield write
+            return
+        loop = asyncio.get_running_loop()
+        f = await loop.run_in_executor(None, open, path, 'r+b', self.CHUNK_SIZE)
+        try:
+            f.seek(offset)
+            async with self._writer(functools.partial(loop.run_in_executor, None, f.write)) as write:
+                yield write
+        finally:
+            await loop.run_in_executor(None, f.close)
+
+    @contextlib.asynccontextmanager
+    async def _writer(self, write: Callable[[bytes], Awaitable]):
+        """
+        Yields async function queuing chunks for a background task that awaits write.
+        Chunks accumulated while previous write is running are joined, so there is one write
+        round-trip per batch rather than one per chunk.
+        """
+        queue: asyncio.Queue[bytes|None] = asyncio.Queue(maxsize=self.WRITE_QUEUE_SIZE)
+
+        async def drain():
+            while True:
+                chunks = [await queue.get()]
+                while not queue.empty():
+                    chunks.append(queue.get_nowait())
+                end = chunks[-1] is None
+                if end:
+                    chunks.pop()
+                if chunks:
+                    await write(b''.join(chunks))
+                if end:
+                    return
+
+        drain_task = asyncio.create_task(drain())
+
+        async def put(data: bytes|None):
+            if drain_task.done():
+                await drain_task  # Raises write error
+            if not queue.full():
+                queue.put_nowait(data)
+                return
+            # Wait for free slot, but don't block forever if writer fails meanwhile
+            put_task = asyncio.create_task(queue.put(data))
+            try:
+                await asyncio.wait((put_task, drain_task), return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                # No-op if put is done, otherwise (writer failed or we were cancelled) it is left pending on queue nobody reads
+                put_task.cancel()
+            if drain_task.done():
+                await drain_task  # Raises write error
+
+        try:
+            yield put
+            await put(None)
+            await drain_task
+        finally:
+            drain_task.cancel()
+
+    def _remaining_bytes(self, file: _FileInfo) -> int:
+        """ Bytes file still needs on disk, 0 if it will be skipped or its size is not known yet """
+        if file.size is None:
+            return 0
+        if file.path.exists() and (file.path.stat().st_size == file.size or not self.allow_override):
+            return 0
+        filepath_part = file.path.with_suffix('.part')
+        if filepath_part.exists():
+            return max(file.size - filepath_part.stat().st_size, 0)
+        return file.size
+
+    def _check_disk_space(self):
+        """ Raises OSError if files left to download don't fit, sizes of files without HEAD request are not known yet """
+        if self._bytes_needed > self._free_space:
+            raise OSError(errno.ENOSPC, f'Need {self._bytes_needed} bytes to download, but only {self._free_space} available',
+                          str(self.download_dir))
+
     async def download_generator(self, *urls:str|tuple[str, str]|tuple[str,Path]) -> AsyncIterator[Path|None]:
         self.console.print(f'Downloading {len(urls)} files to [yellow]{self.download_dir}')
         if self.session is None:
-            self.session = aiohttp.ClientSession()
+            # Keep connections alive so HEAD connection is reused for GET, each download may open SEGMENTS connections
+            per_host = self.concurrent_downloads * (self.SEGMENTS + self.CHECKS_PER_DOWNLOAD)
+            connector = aiohttp.TCPConnector(
+                limit=per_host * 2, limit_per_host=per_host, ttl_dns_cache=300,
+                keepalive_timeout=75,
+            )
+            # No total timeout, otherwise large downloads get killed
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout)
+            self.session = aiohttp.ClientSession(connector=connector, headers=self.default_headers, timeout=timeout)
+        self._urls = urls
+        self._files_checked = 0
+        self._total_bytes = 0
+        self._bytes_needed = 0
+        self._free_space = shutil.disk_usage(self.download_dir).free
         with self.progress:
             self._main_task = self.progress.add_task(f"Checking 0/{len(urls)}", total=None, files_checked=0, files_total=len(urls))
-            check_tasks = [asyncio.create_task(self._check_file(url)) for url in urls]
-            dl_tasks = []
+            check_tasks = {asyncio.create_task(self._check_file(url)) for url in urls}
+            # Downloads start as soon as their check is done, retries as soon as download fails
+            pending = set(check_tasks)
+            checks_left = len(check_tasks)
             try:
-                for fileinfo in asyncio.as_completed(check_tasks):
-                    dl_tasks.append(asyncio.create_task(self._download_file(await fileinfo)))
-                for dl_task in dl_tasks:
-                    fileinfo, retry, ok = await dl_task
-                    if retry >= self.max_retires:
-                        raise StopAsyncIteration
-                    elif ok:
-                        yield fileinfo.path
-                    else:
-                        dl_tasks.append(asyncio.create_task(self._download_file(fileinfo, retry + 1)))
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task in check_tasks:
+                            fileinfo = task.result()
+                            self._bytes_needed += self._remaining_bytes(fileinfo)
+                            checks_left -= 1
+                            if checks_left == 0:
+                                self._check_disk_space()
+                            pending.add(asyncio.create_task(self._download_file(fileinfo)))
+                            continue
+                        fileinfo, retry, ok = task.result()
+                        if ok:
+                            yield fileinfo.path
+                        elif retry < self.max_retires:
+                            pending.add(asyncio.create_task(self._download_file(fileinfo, retry + 1)))
+                        else:
+                            self.console.print(f'[bold red]Failed after {retry + 1} attempts[/bold red] [progress.description]{fileinfo.path.name}')
+                            yield None
             except asyncio.exceptions.CancelledError:
                 self.progress.stop()
                 self.console.print("[red]Download cancelled")
             finally:
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
                 await self.session.close()
 
     async def download(self, *urls:str|tuple[str, str]|tuple[str,Path]):
         return [file async for file in self.download_generator(*urls)]
 
 def download_files(*urls:str|tuple[str, str]|tuple[str,Path], **kwargs):
-    return asyncio.run(AsyncDownloader(**kwargs).download(*urls))
+    try:
+        import uvloop  # Optional, faster socket reads
+        runner = uvloop.run
+    except ImportError:
+        runner = asyncio.run
+    return runner(AsyncDownloader(**kwargs).download(*urls))
 
 def main():
     import argparse